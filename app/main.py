@@ -1,22 +1,55 @@
 # backend/app/main.py
 
+import asyncio
+import base64
 import datetime
 import logging
+import os
+import zlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import msgpack
+import orjson
+from dateutil import parser # Fallback for ISO 8601 forms fromisoformat rejects
 # import time # Not strictly needed for this specific metric, but can be useful for other diagnostics
-from dateutil import parser # For robust ISO 8601 parsing
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, validator
-from typing import List, Optional, Dict, Any
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Response
+from pydantic import AliasChoices, BaseModel, Field, TypeAdapter, create_model, validator
+from pydantic.dataclasses import dataclass
+from typing import List, Optional, Dict, Any, Set
 import uvicorn # For local running if needed
 
+logger = logging.getLogger(__name__)
+
+UTC = datetime.timezone.utc
+
+def _iso_now() -> str:
+    # ISO 8601 UTC with a 'Z' suffix, built from a single aware datetime.
+    return datetime.datetime.now(UTC).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+def _parse_car_timestamp(ts: str) -> datetime.datetime:
+    # Fast C path for the usual isoformat()-style timestamp. Before Python 3.11, fromisoformat
+    # only accepts 3 or 6 fractional digits and "+HH:MM" offsets, so anything else
+    # ("...00.1234Z", "+0000", "20250528T120000Z") falls back to dateutil.
+    try:
+        return datetime.datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    except ValueError:
+        return parser.isoparse(ts)
+
 # --- Pydantic Models ---
-class Waypoint(BaseModel):
+# The nested parts of a frame are slotted, frozen pydantic dataclasses: they are built for
+# every frame (one per waypoint) and never mutated, so they skip the per-instance __dict__.
+# __slots__ is spelled out because dataclass(slots=True) needs Python 3.10.
+@dataclass(frozen=True)
+class Waypoint:
+    __slots__ = ("X", "Y")
     X: float
     Y: float
 
-class SensorData(BaseModel):
+@dataclass(frozen=True)
+class SensorData:
+    __slots__ = ("gps_lat", "gps_lon", "altitude", "velocity", "accel_x", "accel_y", "yaw_rate")
     gps_lat: float
     gps_lon: float
     altitude: float
@@ -25,7 +58,9 @@ class SensorData(BaseModel):
     accel_y: float
     yaw_rate: float
 
-class VehicleControls(BaseModel):
+@dataclass(frozen=True)
+class VehicleControls:
+    __slots__ = ("steering", "throttle")
     steering: float
     throttle: float
 
@@ -34,9 +69,11 @@ class CarData(BaseModel):
     sensor_data: SensorData
     inference_mode: str
     vehicle_controls: VehicleControls
-    image1_base64: Optional[str] = None
+    # Raw image bytes. msgpack frames carry them as-is; JSON frames still send base64 text
+    # under the old image1_base64/image2_base64 keys, which is decoded on validation.
+    image1: Optional[bytes] = Field(default=None, validation_alias=AliasChoices("image1", "image1_base64"))
     unique_id_image1: Optional[str] = None
-    image2_base64: Optional[str] = None
+    image2: Optional[bytes] = Field(default=None, validation_alias=AliasChoices("image2", "image2_base64"))
     unique_id_image2: Optional[str] = None
     energy_used_wh: Optional[float] = None
     timestamp_car_sent_utc: str
@@ -59,105 +96,292 @@ class CarData(BaseModel):
             else:
                 raise ValueError(f"Invalid waypoint entry: {wp!r}")
         return converted
+
+    @validator("image1", "image2", pre=True)
+    def _decode_base64_images(cls, v):
+        if not isinstance(v, str):
+            return v
+        try:
+            # validate=True rejects characters outside the alphabet (e.g. a "data:...;base64,"
+            # prefix) instead of silently skipping them and caching corrupt bytes.
+            return base64.b64decode(v, validate=True)
+        except ValueError as e: # binascii.Error, and non-ASCII input
+            logger.warning("Dropping image with invalid base64: %s", e)
+            return None
 # --- End Pydantic Models ---
 
+# Bound once so the per-frame path hands the dict straight to pydantic-core (no **kwargs unpacking).
+_validate_car_data = TypeAdapter(CarData).validate_python
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global new_frame_event
+    # Created here, not at import, so it is bound to the server's running event loop.
+    new_frame_event = asyncio.Event()
+    broadcaster_task = asyncio.create_task(_broadcaster())
+    try:
+        yield
+    finally:
+        broadcaster_task.cancel()
+
 app = FastAPI(
     title="Car Data Backend",
     description="Calculates data transit time from car and broadcasts updates.",
-    version="1.3.0" 
+    version="1.3.0",
+    lifespan=lifespan,
 )
 
 # --- CORS Middleware ---
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"], # Restrict in production
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+# The allowed origin is fixed at startup, so every CORS header is precomputed and appended as-is
+# instead of being derived from each request's Origin. Set CORS_ALLOW_ORIGIN to the UI's
+# origin in production.
+CORS_ALLOW_ORIGIN = os.environ.get("CORS_ALLOW_ORIGIN", "*")
+
+class StaticCORSMiddleware:
+    def __init__(self, app, allow_origin: str):
+        self.app = app
+        self.response_headers = [(b"access-control-allow-origin", allow_origin.encode("latin-1"))]
+        if allow_origin != "*":
+            self.response_headers.append((b"vary", b"Origin"))
+        self.preflight_headers = self.response_headers + [
+            (b"access-control-allow-methods", b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"),
+            (b"access-control-max-age", b"600"),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] == "OPTIONS":
+            request_headers = dict(scope["headers"])
+            # Only a real preflight is short-circuited; any other OPTIONS request falls through
+            # to the app (405/404) like it did with CORSMiddleware.
+            if b"origin" in request_headers and b"access-control-request-method" in request_headers:
+                headers = self.preflight_headers
+                requested_headers = request_headers.get(b"access-control-request-headers")
+                if requested_headers:
+                    # Echoed rather than "*", which the Fetch spec does not apply to Authorization.
+                    headers = headers + [(b"access-control-allow-headers", requested_headers)]
+                await send({"type": "http.response.start", "status": 204, "headers": headers})
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+        async def send_with_cors_headers(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), *self.response_headers]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors_headers)
+
+app.add_middleware(StaticCORSMiddleware, allow_origin=CORS_ALLOW_ORIGIN)
+
+# JSON bytes of the latest accepted car frame (see _serialize_broadcast_payload), encoded once
+# per frame and reused by every reader.
+latest_payload_bytes: bytes = b"null"
+# zlib-compressed latest_payload_bytes as sent to UI clients in binary frames. It is
+# compressed once here rather than per connection by permessage-deflate (disabled in the Dockerfile).
+BROADCAST_COMPRESSION_LEVEL = 6
+latest_broadcast_frame: Optional[bytes] = None
+# Set by the car endpoint whenever latest_payload_bytes changes; _broadcaster picks up only the
+# newest payload, so frames that arrive faster than the fanout are coalesced instead of queued.
+new_frame_event: Optional[asyncio.Event] = None
+
+# Car images keyed by unique_id_imageN. Frames are broadcast without the image fields;
+# UI clients fetch the bytes they need from /api/image/{img_id}.
+IMAGE_CACHE_MAX_ENTRIES = 64
+IMAGE_FIELDS = (("image1", "unique_id_image1"), ("image2", "unique_id_image2"))
+image_cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+def _cache_images(car_data: CarData):
+    for image_field, id_field in IMAGE_FIELDS:
+        image = getattr(car_data, image_field)
+        img_id = getattr(car_data, id_field)
+        if not image or not img_id:
+            continue
+        image_cache[img_id] = image
+        image_cache.move_to_end(img_id)
+        while len(image_cache) > IMAGE_CACHE_MAX_ENTRIES:
+            image_cache.popitem(last=False)
+
+# Every CarData field except the raw image bytes, which are served from /api/image/{img_id}.
+BROADCAST_FIELDS = tuple(name for name in CarData.model_fields if name not in ("image1", "image2"))
+# Schema-only model describing that payload, for the OpenAPI docs of /api/latest_car_data.
+CarDataSnapshot = create_model(
+    "CarDataSnapshot",
+    **{name: (field.annotation, field) for name, field in CarData.model_fields.items() if name in BROADCAST_FIELDS},
 )
 
-latest_car_data_store: Optional[CarData] = None
+def _serialize_broadcast_payload(car_data: CarData) -> bytes:
+    # Built from the validated model, so unknown keys and unconverted values from the car never
+    # reach readers. The nested parts are dataclasses that orjson encodes natively, so this
+    # skips model_dump()'s intermediate dict walk.
+    return orjson.dumps({name: getattr(car_data, name) for name in BROADCAST_FIELDS})
 
 class ConnectionManager:
-    def __init__(self, manager_name: str = "default"):
-        self.active_connections: List[WebSocket] = []
+    # Upper bound on sends in flight at once across all of this manager's writer tasks.
+    MAX_CONCURRENT_SENDS = 256
+    # A send that cannot complete in this many seconds marks the client as stuck; it is dropped
+    # so it cannot keep holding one of the slots above.
+    SEND_TIMEOUT = 5.0
+
+    def __init__(self, manager_name: str = "default", broadcasts: bool = True):
+        self.active_connections: Set[WebSocket] = set()
         self.manager_name = manager_name
+        self.broadcasts = broadcasts
+        # One single-slot outbox and writer task per client (only if this manager broadcasts):
+        # a slow client only ever holds the newest frame, and never blocks the other clients.
+        self._send_queues: Dict[WebSocket, asyncio.Queue] = {}
+        self._writer_tasks: Dict[WebSocket, asyncio.Task] = {}
+        # Created on first connect so it belongs to the server's running event loop.
+        self._send_slots: Optional[asyncio.Semaphore] = None
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
-        logging.info(f"[{self.manager_name}] WS client connected: {websocket.client.host}:{websocket.client.port}")
+        self.active_connections.add(websocket)
+        if self.broadcasts:
+            if self._send_slots is None:
+                self._send_slots = asyncio.Semaphore(self.MAX_CONCURRENT_SENDS)
+            self._send_queues[websocket] = asyncio.Queue(maxsize=1)
+            self._writer_tasks[websocket] = asyncio.create_task(self._writer(websocket))
+        logger.info("[%s] WS client connected: %s:%s", self.manager_name, websocket.client.host, websocket.client.port)
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        logging.info(f"[{self.manager_name}] WS client disconnected: {websocket.client.host}:{websocket.client.port}")
-
-    async def broadcast_json_object(self, data: dict):
-        if not self.active_connections: return
-        disconnected_clients: List[WebSocket] = []
-        for connection in list(self.active_connections): 
+        self.active_connections.discard(websocket)
+        self._send_queues.pop(websocket, None)
+        writer_task = self._writer_tasks.pop(websocket, None)
+        if writer_task is not None and writer_task is not asyncio.current_task():
+            writer_task.cancel()
+        logger.info("[%s] WS client disconnected: %s:%s", self.manager_name, websocket.client.host, websocket.client.port)
+
+    async def _writer(self, websocket: WebSocket):
+        queue = self._send_queues[websocket]
+        while True:
+            payload = await queue.get()
             try:
-                await connection.send_json(data)
+                async with self._send_slots:
+                    await asyncio.wait_for(websocket.send_bytes(payload), self.SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("[%s] Client %s:%s did not accept a frame within %ss; dropping it", self.manager_name, websocket.client.host, websocket.client.port, self.SEND_TIMEOUT)
+                self.disconnect(websocket)
+                try:
+                    await asyncio.wait_for(websocket.close(code=1011), self.SEND_TIMEOUT)
+                except Exception:
+                    pass
+                return
             except (WebSocketDisconnect, RuntimeError) as e:
-                disconnected_clients.append(connection)
-                logging.warning(f"[{self.manager_name}] Client {connection.client.host}:{connection.client.port} disconnected or error during broadcast: {type(e).__name__}")
+                logger.warning("[%s] Client %s:%s disconnected or error during broadcast: %s", self.manager_name, websocket.client.host, websocket.client.port, type(e).__name__)
+                self.disconnect(websocket)
+                return
             except Exception as e:
-                logging.error(f"[{self.manager_name}] Error sending to {connection.client.host}:{connection.client.port}: {e}")
-        for client in disconnected_clients:
-            if client in self.active_connections: self.disconnect(client)
+                logger.error("[%s] Error sending to %s:%s: %s", self.manager_name, websocket.client.host, websocket.client.port, e)
 
-car_connection_manager = ConnectionManager(manager_name="CarClients")
+    def send_serialized(self, websocket: WebSocket, payload: bytes):
+        queue = self._send_queues.get(websocket)
+        if queue is None: return
+        # Drop the frame the client has not picked up yet; only the newest one matters.
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(payload)
+
+    def broadcast_serialized(self, payload: bytes):
+        # `payload` is already encoded (and compressed) once, not once per client.
+        for connection in list(self.active_connections):
+            self.send_serialized(connection, payload)
+
+async def _receive_car_frame(websocket: WebSocket) -> Any:
+    # Text frames are JSON; binary frames are msgpack (images as raw bytes). Both decoders reject
+    # trailing data, so a garbled or concatenated frame raises instead of half-decoding.
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    raw = message.get("bytes")
+    if raw is None:
+        return orjson.loads(message["text"])
+    return msgpack.unpackb(raw)
+
+car_connection_manager = ConnectionManager(manager_name="CarClients", broadcasts=False)
 ui_connection_manager = ConnectionManager(manager_name="UIClients")
 
+# Strong references to fire-and-forget tasks; the event loop only keeps weak ones.
+_background_tasks: Set[asyncio.Task] = set()
+
+def _spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def _publish_frame(car_data: CarData):
+    global latest_payload_bytes
+    try:
+        _cache_images(car_data)
+        latest_payload_bytes = _serialize_broadcast_payload(car_data)
+    except Exception as e:
+        logger.error("Error publishing car data: %s", e)
+        return
+    if new_frame_event is not None:
+        new_frame_event.set()
+
+async def _broadcaster():
+    global latest_broadcast_frame
+    while True:
+        await new_frame_event.wait()
+        new_frame_event.clear()
+        try:
+            latest_broadcast_frame = zlib.compress(latest_payload_bytes, BROADCAST_COMPRESSION_LEVEL)
+            ui_connection_manager.broadcast_serialized(latest_broadcast_frame)
+        except Exception as e:
+            logger.error("Error broadcasting car data to UI clients: %s", e)
+
 @app.websocket("/ws/car_data")
 async def websocket_car_data_endpoint(websocket: WebSocket):
     await car_connection_manager.connect(websocket)
-    global latest_car_data_store
     try:
         while True:
-            server_receive_time_obj = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
-            data_json = await websocket.receive_json()
+            server_receive_time_obj = datetime.datetime.now(UTC)
+            data_json = await _receive_car_frame(websocket)
 
             try:
-                car_data_received = CarData(**data_json) 
+                car_data_received = _validate_car_data(data_json)
                 car_data_received.timestamp_server_received_utc = server_receive_time_obj.isoformat().replace("+00:00", "Z")
 
                 try:
-                    car_sent_time_obj = parser.isoparse(car_data_received.timestamp_car_sent_utc)
+                    car_sent_time_obj = _parse_car_timestamp(car_data_received.timestamp_car_sent_utc)
                     if car_sent_time_obj.tzinfo is None or car_sent_time_obj.tzinfo.utcoffset(car_sent_time_obj) is None:
-                        logging.warning(f"Car timestamp '{car_data_received.timestamp_car_sent_utc}' was naive. Assuming UTC.")
-                        car_sent_time_obj = car_sent_time_obj.replace(tzinfo=datetime.timezone.utc)
+                        logger.warning("Car timestamp '%s' was naive. Assuming UTC.", car_data_received.timestamp_car_sent_utc)
+                        car_sent_time_obj = car_sent_time_obj.replace(tzinfo=UTC)
                     
                     latency_delta = server_receive_time_obj - car_sent_time_obj
                     transit_time_ms = round(abs(latency_delta.total_seconds() * 1000.0), 2)
                     car_data_received.data_transit_time_to_server_ms = transit_time_ms
                     
                     if transit_time_ms < -10: # Allow small negative tolerance
-                        logging.warning(f"Negative transit time ({transit_time_ms} ms). Clock skew suspected.")
+                        logger.warning("Negative transit time (%s ms). Clock skew suspected.", transit_time_ms)
                     elif transit_time_ms > 10000: 
-                         logging.warning(f"High transit time ({transit_time_ms} ms). Possible clock skew/network issue.")
+                         logger.warning("High transit time (%s ms). Possible clock skew/network issue.", transit_time_ms)
                 except Exception as time_parse_error:
-                    logging.error(f"Error parsing car timestamp or calculating transit: {time_parse_error}. TS was: '{car_data_received.timestamp_car_sent_utc}'")
+                    logger.error("Error parsing car timestamp or calculating transit: %s. TS was: '%s'", time_parse_error, car_data_received.timestamp_car_sent_utc)
                     car_data_received.data_transit_time_to_server_ms = None
                 
-                latest_car_data_store = car_data_received
-                logging.info(f"Data stored. Transit: {car_data_received.data_transit_time_to_server_ms} ms.")
-
-                if latest_car_data_store:
-                    await ui_connection_manager.broadcast_json_object(latest_car_data_store.model_dump())
+                # Publishing runs after the ACK is on its way, so the car's measured response time
+                # does not include image caching, payload encoding or the UI fanout.
+                _spawn_background(_publish_frame(car_data_received))
+                logger.debug("Data stored. Transit: %s ms.", car_data_received.data_transit_time_to_server_ms)
 
-                await websocket.send_json({
+                await websocket.send_bytes(orjson.dumps({
                     "status": "received",
                     "message_processed_at_utc": car_data_received.timestamp_server_received_utc
-                })
+                }))
             except Exception as e:
-                logging.error(f"Error processing car data: {e} - Raw: {data_json}")
-                await websocket.send_json({"status": "error", "message": str(e)})
+                logger.error("Error processing car data: %s", e)
+                # The raw frame carries base64 images; only its shape is logged, and only when debugging.
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Rejected frame keys: %s", sorted(data_json) if isinstance(data_json, dict) else type(data_json).__name__)
+                await websocket.send_bytes(orjson.dumps({"status": "error", "message": str(e)}))
     except WebSocketDisconnect:
-        logging.info(f"Car WS disconnected: {websocket.client.host}:{websocket.client.port}")
+        logger.info("Car WS disconnected: %s:%s", websocket.client.host, websocket.client.port)
     except Exception as e:
-        logging.error(f"Car WS error: {e} for {websocket.client.host}:{websocket.client.port}")
+        logger.error("Car WS error: %s for %s:%s", e, websocket.client.host, websocket.client.port)
         try: await websocket.close(code=1011)
         except RuntimeError: pass
     finally:
@@ -181,11 +405,8 @@ async def websocket_ui_endpoint(websocket: WebSocket):
     await ui_connection_manager.connect(websocket)
     try:
         # Send the current latest data immediately upon connection if available
-        if latest_car_data_store:
-            try:
-                await websocket.send_json(latest_car_data_store.model_dump())
-            except Exception as e:
-                logging.error(f"Error sending initial data to UI client {websocket.client.host}:{websocket.client.port}: {e}")
+        if latest_broadcast_frame:
+            ui_connection_manager.send_serialized(websocket, latest_broadcast_frame)
         
         # Keep the connection alive and detect disconnections
         while True:
@@ -195,27 +416,39 @@ async def websocket_ui_endpoint(websocket: WebSocket):
             await websocket.receive_text() # This will raise WebSocketDisconnect if client closes
 
     except WebSocketDisconnect:
-        logging.info(f"UI WebSocket disconnected by client: {websocket.client.host}:{websocket.client.port}")
+        logger.info("UI WebSocket disconnected by client: %s:%s", websocket.client.host, websocket.client.port)
     except Exception as e:
-        logging.error(f"Unexpected UI WebSocket error for {websocket.client.host}:{websocket.client.port}: {e}")
+        logger.error("Unexpected UI WebSocket error for %s:%s: %s", websocket.client.host, websocket.client.port, e)
         # No need to explicitly close here if an exception occurs, FastAPI handles it,
         # but ensure disconnect is called in finally.
     finally:
         ui_connection_manager.disconnect(websocket)
 
 
-@app.get("/api/latest_car_data", response_model=Optional[CarData])
+# No response_model: the body is never validated or re-serialized per request. The schema is
+# still advertised through `responses` for the OpenAPI docs; the body is null until the first frame.
+@app.get(
+    "/api/latest_car_data",
+    responses={200: {"model": Optional[CarDataSnapshot], "description": "Latest car frame without images, or null"}},
+)
 async def get_latest_car_data():
-    # ... (This endpoint remains the same) ...
-    if latest_car_data_store: return latest_car_data_store
-    return None
+    # Serve the cached JSON bytes as-is; they are only re-encoded when the car pushes a new frame.
+    return Response(content=latest_payload_bytes, media_type="application/json")
+
+@app.get("/api/image/{img_id}")
+async def get_image(img_id: str):
+    image = image_cache.get(img_id)
+    if image is None:
+        raise HTTPException(status_code=404, detail=f"Image '{img_id}' not found or evicted")
+    image_cache.move_to_end(img_id)
+    return Response(content=image, media_type="image/jpeg")
 
 @app.get("/debug/time_check") # Changed endpoint name slightly for clarity
 async def get_server_time_check():
     return {
         "description": "Current time as seen by the backend server application",
-        "server_utc_timestamp_iso": datetime.datetime.utcnow().isoformat() + "Z",
-        "server_datetime_object_utc": str(datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)),
+        "server_utc_timestamp_iso": _iso_now(),
+        "server_datetime_object_utc": str(datetime.datetime.now(UTC)),
         "server_datetime_object_local": str(datetime.datetime.now().astimezone()), # Includes local TZ info
     }
 
@@ -227,6 +460,7 @@ async def read_root():
         "car_websocket_endpoint": "/ws/car_data",
         "ui_websocket_endpoint": "/api/ui_updates",
         "latest_data_http_endpoint": "/api/latest_car_data",
+        "image_http_endpoint": "/api/image/{img_id}",
         "debug_timedatectl": "/debug/time_check"
     }
 